@@ -1,13 +1,27 @@
+import asyncio
+import io
 import os
+import json
 import sqlite3
 import hashlib
-from datetime import datetime
+import hmac
+import threading
+from datetime import datetime, timedelta
 
 import streamlit as st
-from openai import OpenAI
+import tiktoken
+from openai import AsyncOpenAI, OpenAI
 from pypdf import PdfReader
 import docx
 import base64
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+
+# PyMuPDF is much faster than pypdf; fall back to pypdf where it isn't installed.
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
 
 # ------------- CONFIG & CLIENT ------------- #
 st.set_page_config(
@@ -26,14 +40,34 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 DB_PATH = "app.db"
 
 
+# Streamlit re-executes this module (often on a new thread) for every rerun, so
+# a single connection shared by all reruns and sessions lives in cache_resource.
+# Writers serialize on get_write_lock() so their transactions don't interleave.
+@st.cache_resource
 def get_conn():
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
 
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+
+# Runs once per server process rather than on every rerun.
+@st.cache_resource
 def init_db():
-    conn = get_conn()
+    with get_write_lock():
+        _create_schema(get_conn())
+
+
+def _create_schema(conn):
+    # WAL is persisted in the database file, so readers stop blocking the writer.
+    conn.execute("PRAGMA journal_mode=WAL")
     cur = conn.cursor()
 
     cur.execute(
@@ -57,68 +91,185 @@ def init_db():
             chapter_label TEXT,
             content TEXT NOT NULL,
             created_at TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
+            content_sha TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(content_sha) REFERENCES file_blobs(sha)
+        );
+        """
+    )
+
+    # Databases created before file_blobs existed lack the content_sha column.
+    chapter_columns = [r["name"] for r in cur.execute("PRAGMA table_info(chapters)")]
+    if "content_sha" not in chapter_columns:
+        cur.execute("ALTER TABLE chapters ADD COLUMN content_sha TEXT REFERENCES file_blobs(sha)")
+
+    # Parsed text of uploaded files, keyed by the SHA-256 of the raw file bytes,
+    # so re-uploading the same file neither re-parses nor re-stores it.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_blobs (
+            sha TEXT PRIMARY KEY,
+            parsed_text TEXT NOT NULL
         );
         """
     )
 
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            ttl_seconds INTEGER
+        );
+        """
+    )
+
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chapters_user_created ON chapters(user_id, created_at DESC);"
+    )
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email);")
+
     conn.commit()
-    conn.close()
 
 
 init_db()
 
 
 # ------------- AUTH HELPERS ------------- #
+_password_hasher = PasswordHasher()
+
+
 def hash_password(password: str) -> str:
+    return _password_hasher.hash(password)
+
+
+# Verified against when the email is unknown, so a login attempt takes about as
+# long whether or not the account exists. Cached to hash it once per process.
+@st.cache_resource
+def _get_dummy_password_hash():
+    return _password_hasher.hash(os.urandom(16).hex())
+
+
+def _legacy_hash_password(password: str) -> str:
+    # Unsalted SHA-256 used by accounts created before the switch to Argon2.
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
+def verify_password(password_hash: str, password: str) -> bool:
+    if not password_hash.startswith("$argon2"):
+        return hmac.compare_digest(password_hash, _legacy_hash_password(password))
+    try:
+        return _password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHash):
+        return False
+
+
 def create_user(email: str, password: str):
     conn = get_conn()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, ?)",
-            (email, hash_password(password), datetime.utcnow().isoformat()),
-        )
-        conn.commit()
+        with get_write_lock(), conn:
+            conn.execute(
+                "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, ?)",
+                (email, hash_password(password), datetime.utcnow().isoformat()),
+            )
     except sqlite3.IntegrityError:
-        conn.close()
         return False, "Email already registered."
-    conn.close()
     return True, "User created successfully."
 
 
 def authenticate_user(email: str, password: str):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM users WHERE email = ? AND password_hash = ?",
-        (email, hash_password(password)),
+    cur = conn.execute(
+        "SELECT id, email, password_hash, created_at FROM users WHERE email = ?",
+        (email,),
     )
     row = cur.fetchone()
-    conn.close()
-    if row:
-        return dict(row)
-    return None
+    if not row:
+        verify_password(_get_dummy_password_hash(), password)
+        return None
+    if not verify_password(row["password_hash"], password):
+        return None
+
+    # Upgrade legacy SHA-256 hashes (and outdated Argon2 parameters) on login.
+    if not row["password_hash"].startswith("$argon2") or _password_hasher.check_needs_rehash(
+        row["password_hash"]
+    ):
+        with get_write_lock(), conn:
+            conn.execute(
+                "UPDATE users SET password_hash = ? WHERE id = ?",
+                (hash_password(password), row["id"]),
+            )
+
+    return {"id": row["id"], "email": row["email"], "created_at": row["created_at"]}
 
 
 # ------------- FILE PARSERS ------------- #
-def extract_text_from_pdf(uploaded_file):
-    reader = PdfReader(uploaded_file)
-    text = ""
+# Parsed text is cached per file digest so reruns with the same upload skip the parse.
+# Leading underscore keeps Streamlit from hashing the raw bytes a second time.
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def _extract_pdf_cached(digest: str, _file_bytes: bytes):
+    # Both backends join pages with "\n" so the chapter text (and the LLM cache
+    # keys built from it) doesn't depend on which one is installed.
+    if pymupdf is not None:
+        with pymupdf.open(stream=_file_bytes, filetype="pdf") as doc:
+            return "\n".join(page.get_text("text") for page in doc)
+
+    reader = PdfReader(io.BytesIO(_file_bytes))
+    parts = []
     for page in reader.pages:
-        text += page.extract_text() or ""
-    return text
+        parts.append(page.extract_text() or "")
+    return "\n".join(parts)
+
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def _extract_docx_cached(digest: str, _file_bytes: bytes):
+    doc = docx.Document(io.BytesIO(_file_bytes))
+    return "\n".join(para.text for para in doc.paragraphs if para.text)
+
 
+def extract_text_from_upload(uploaded_file):
+    """Return `(sha, text)` for an uploaded file, reusing text parsed from an
+    identical earlier upload when one is stored in `file_blobs`."""
+    file_bytes = uploaded_file.getvalue()
+    digest = hashlib.sha256(file_bytes).hexdigest()
 
-def extract_text_from_docx(uploaded_file):
-    doc = docx.Document(uploaded_file)
-    return "\n".join([para.text for para in doc.paragraphs])
+    stored = get_file_blob_text(digest)
+    if stored is not None:
+        return digest, stored
+
+    if uploaded_file.type == "application/pdf":
+        return digest, _extract_pdf_cached(digest, file_bytes)
+    if (
+        uploaded_file.type
+        == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    ):
+        return digest, _extract_docx_cached(digest, file_bytes)
+    return digest, file_bytes.decode("utf-8")
 
 
 # ------------- PRINT BUTTON ------------- #
+# Shared by the quiz and cheat-sheet pages; only built right after a generation.
+def _build_printable_html(kind: str, title: str, label: str, body_text: str):
+    body_html = body_text.replace("\n", "<br>")
+    return f"""
+        <html>
+        <head>
+        <title>{kind} – {label}</title>
+        <style>
+        body {{ font-family: Arial, sans-serif; margin: 40px; }}
+        h1, h2 {{ text-align: center; }}
+        </style>
+        </head>
+        <body>
+        <h1>{kind}</h1>
+        <h2>{title} – {label}</h2>
+        <div>{body_html}</div>
+        </body>
+        </html>
+        """
+
+
 def make_print_button(html_content: str, label: str = "🖨️ Print"):
     b64 = base64.b64encode(html_content.encode()).decode()
     href = f"""
@@ -132,7 +283,217 @@ def make_print_button(html_content: str, label: str = "🖨️ Print"):
 
 
 # ------------- OPENAI HELPERS ------------- #
-def generate_quiz_from_text(
+# Prompts are laid out static -> chapter -> parameters so regenerations against the
+# same chapter share an identical prefix and hit OpenAI's automatic prompt cache.
+QUIZ_SYSTEM_PROMPT = """
+You are an expert teacher.
+
+Create quiz questions ONLY from the chapter text provided by the user.
+Only include the sections the requirements ask for.
+
+Format them clearly with headings:
+
+## Multiple Choice
+Q1. ...
+A. ...
+B. ...
+C. ...
+D. ...
+Correct: B
+
+## Subjective
+Q1. ...
+Answer (for teacher only): ...
+
+## True/False
+Q1. Statement...
+Answer: True
+"""
+
+CHEAT_SHEET_SYSTEM_PROMPT = """
+You are an expert educator.
+
+Summarize the chapter provided by the user into a cheat sheet for students.
+
+Use the chapter text and create:
+
+- A short overview (2–3 sentences)
+- 5–15 bullet points of the MOST important ideas
+- Definitions of key terms (if present)
+- Optional: small example or analogy where helpful
+
+Keep it student-friendly and concise.
+"""
+
+
+LLM_MODEL = "gpt-4.1-mini"
+QUIZ_TEMPERATURE = 0.3
+CHEAT_SHEET_TEMPERATURE = 0.4
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def _llm_cache_key(messages, model: str, temperature: float):
+    return hashlib.sha256(
+        json.dumps(
+            {"model": model, "temperature": temperature, "messages": messages},
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def _llm_cache_get(key: str, now: datetime):
+    conn = get_conn()
+    cur = conn.execute("SELECT response, created_at, ttl_seconds FROM llm_cache WHERE key = ?", (key,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    expired = row["ttl_seconds"] is not None and (
+        datetime.fromisoformat(row["created_at"]) + timedelta(seconds=row["ttl_seconds"]) <= now
+    )
+    if not expired:
+        return row["response"]
+    with get_write_lock(), conn:
+        conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+    return None
+
+
+def _llm_cache_put(key: str, content: str, finish_reason, now: datetime, ttl_seconds):
+    conn = get_conn()
+    with get_write_lock(), conn:
+        # Keys rarely repeat, so expired rows are swept here rather than only on lookup.
+        conn.execute(
+            """
+            DELETE FROM llm_cache
+            WHERE ttl_seconds IS NOT NULL
+              AND datetime(created_at, '+' || ttl_seconds || ' seconds') <= datetime(?)
+            """,
+            (now.isoformat(),),
+        )
+        # Empty, truncated or filtered completions aren't cached so they can be regenerated.
+        if finish_reason != "stop" or not content:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, created_at, ttl_seconds) VALUES (?, ?, ?, ?)",
+            (key, content, now.isoformat(), ttl_seconds),
+        )
+
+
+def _usage_dict(raw_usage):
+    return {
+        "prompt_tokens": raw_usage.prompt_tokens,
+        "cached_tokens": getattr(raw_usage.prompt_tokens_details, "cached_tokens", 0) or 0,
+        "completion_tokens": raw_usage.completion_tokens,
+        "response_cache_hit": False,
+    }
+
+
+CACHE_HIT_USAGE = {
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "completion_tokens": 0,
+    "response_cache_hit": True,
+}
+
+
+def cached_chat(
+    messages, model: str, temperature: float, usage=None, ttl_seconds=LLM_CACHE_TTL_SECONDS
+):
+    """Yield the completion text for `messages` as it streams in, replaying a stored
+    response when the exact same request was made before. `ttl_seconds=None` never
+    expires.
+
+    If a `usage` dict is given it is filled with token counts once the stream ends,
+    including how many prompt tokens OpenAI served from its prompt cache."""
+    if usage is None:
+        usage = {}
+    key = _llm_cache_key(messages, model, temperature)
+    now = datetime.utcnow()
+
+    cached = _llm_cache_get(key, now)
+    if cached is not None:
+        usage.update(CACHE_HIT_USAGE)
+        yield cached
+        return
+
+    stream = client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parts = []
+    finish_reason = None
+    for chunk in stream:
+        # With include_usage the last chunk carries token counts and no choices.
+        if chunk.usage:
+            usage.update(_usage_dict(chunk.usage))
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+        delta = choice.delta.content or ""
+        parts.append(delta)
+        yield delta
+
+    _llm_cache_put(key, "".join(parts), finish_reason, now, ttl_seconds)
+
+
+async def cached_chat_async(
+    aclient, messages, model: str, temperature: float, usage=None, ttl_seconds=LLM_CACHE_TTL_SECONDS
+):
+    """Non-streaming async counterpart of `cached_chat`, sharing the same cache."""
+    if usage is None:
+        usage = {}
+    key = _llm_cache_key(messages, model, temperature)
+    now = datetime.utcnow()
+
+    cached = _llm_cache_get(key, now)
+    if cached is not None:
+        usage.update(CACHE_HIT_USAGE)
+        return cached
+
+    response = await aclient.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        messages=messages,
+    )
+    choice = response.choices[0]
+    content = choice.message.content or ""
+    usage.update(_usage_dict(response.usage))
+
+    _llm_cache_put(key, content, choice.finish_reason, now, ttl_seconds)
+    return content
+
+
+MAX_CHAPTER_TOKENS = 12000
+
+
+@st.cache_resource
+def _get_encoding():
+    try:
+        return tiktoken.encoding_for_model(LLM_MODEL)
+    except KeyError:
+        # Older tiktoken releases don't know the gpt-4.1 family yet.
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Cached so regenerating against the same chapter does not re-tokenize it.
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def truncate_to_tokens(text: str, max_tokens: int = MAX_CHAPTER_TOKENS):
+    enc = _get_encoding()
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+def build_chapter_message(text: str):
+    return {"role": "user", "content": f"Chapter text:\n\"\"\"{truncate_to_tokens(text)}\"\"\"\n"}
+
+
+def build_quiz_messages(
     text: str,
     chapter_label: str,
     question_type: str,
@@ -158,115 +519,193 @@ def generate_quiz_from_text(
 
     requirements = "\n".join(instructions)
 
-    prompt = f"""
-You are an expert teacher.
-
-Create quiz questions ONLY from the text below.
+    parameters = f"""
 Chapter: {chapter_label}
 Difficulty: {difficulty}
 
-TEXT:
-\"\"\"{text[:15000]}\"\"\"
-
 Requirements:
 {requirements}
+"""
 
-Format them clearly with headings:
-
-## Multiple Choice
-Q1. ...
-A. ...
-B. ...
-C. ...
-D. ...
-Correct: B
+    return [
+        {"role": "system", "content": QUIZ_SYSTEM_PROMPT},
+        build_chapter_message(text),
+        {"role": "user", "content": parameters},
+    ]
 
-## Subjective
-Q1. ...
-Answer (for teacher only): ...
 
-## True/False
-Q1. Statement...
-Answer: True
+def build_cheat_sheet_messages(text: str, chapter_label: str, difficulty: str):
+    parameters = f"""
+Chapter: {chapter_label}
+Level: {difficulty}
 """
 
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        temperature=0.3,
-        messages=[{"role": "user", "content": prompt}],
+    return [
+        {"role": "system", "content": CHEAT_SHEET_SYSTEM_PROMPT},
+        build_chapter_message(text),
+        {"role": "user", "content": parameters},
+    ]
+
+
+def generate_quiz_from_text(
+    text: str,
+    chapter_label: str,
+    question_type: str,
+    difficulty: str,
+    num_mcq: int,
+    num_subjective: int,
+    num_tf: int,
+):
+    usage = {}
+    stream = cached_chat(
+        messages=build_quiz_messages(
+            text, chapter_label, question_type, difficulty, num_mcq, num_subjective, num_tf
+        ),
+        model=LLM_MODEL,
+        temperature=QUIZ_TEMPERATURE,
+        usage=usage,
     )
-    return response.choices[0].message.content
+    return stream, usage
 
 
 def generate_cheat_sheet(text: str, chapter_label: str, difficulty: str):
-    prompt = f"""
-You are an expert educator.
+    usage = {}
+    stream = cached_chat(
+        messages=build_cheat_sheet_messages(text, chapter_label, difficulty),
+        model=LLM_MODEL,
+        temperature=CHEAT_SHEET_TEMPERATURE,
+        usage=usage,
+    )
+    return stream, usage
 
-Summarize the chapter into a cheat sheet for students.
 
-Chapter: {chapter_label}
-Level: {difficulty}
+async def generate_both(
+    text: str,
+    chapter_label: str,
+    question_type: str,
+    difficulty: str,
+    num_mcq: int,
+    num_subjective: int,
+    num_tf: int,
+    cheat_sheet_level: str,
+):
+    """Generate a quiz and a cheat sheet for the same chapter concurrently.
+
+    Returns `((quiz_text, quiz_usage), (cheat_text, cheat_usage))`."""
+    quiz_usage, cheat_usage = {}, {}
+    # A fresh client per call: its connection pool is bound to the asyncio.run loop.
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as aclient:
+        quiz_text, cheat_text = await asyncio.gather(
+            cached_chat_async(
+                aclient,
+                build_quiz_messages(
+                    text, chapter_label, question_type, difficulty, num_mcq, num_subjective, num_tf
+                ),
+                model=LLM_MODEL,
+                temperature=QUIZ_TEMPERATURE,
+                usage=quiz_usage,
+            ),
+            cached_chat_async(
+                aclient,
+                build_cheat_sheet_messages(text, chapter_label, cheat_sheet_level),
+                model=LLM_MODEL,
+                temperature=CHEAT_SHEET_TEMPERATURE,
+                usage=cheat_usage,
+            ),
+        )
+    return (quiz_text, quiz_usage), (cheat_text, cheat_usage)
 
-Use the text below and create:
 
-- A short overview (2–3 sentences)
-- 5–15 bullet points of the MOST important ideas
-- Definitions of key terms (if present)
-- Optional: small example or analogy where helpful
+# ------------- CHAPTER STORAGE ------------- #
+def get_file_blob_text(sha: str):
+    conn = get_conn()
+    cur = conn.execute("SELECT parsed_text FROM file_blobs WHERE sha = ?", (sha,))
+    row = cur.fetchone()
+    if row:
+        return row["parsed_text"]
+    return None
 
-Keep it student-friendly and concise.
 
-TEXT:
-\"\"\"{text[:15000]}\"\"\"
-"""
+def save_chapters(user_id: int, rows, blobs=()):
+    """Insert several chapters in a single transaction.
 
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        temperature=0.4,
-        messages=[{"role": "user", "content": prompt}],
-    )
-    return response.choices[0].message.content
+    `rows` is an iterable of `(title, isbn, chapter_label, content, content_sha)`
+    tuples. Chapters backed by an uploaded file pass an empty `content` and the
+    file's `content_sha`; its text goes in `blobs` as `(sha, parsed_text)` pairs.
+    """
+    created_at = datetime.utcnow().isoformat()
+    conn = get_conn()
+    with get_write_lock(), conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO file_blobs (sha, parsed_text) VALUES (?, ?)",
+            blobs,
+        )
+        conn.executemany(
+            """
+            INSERT INTO chapters (user_id, title, isbn, chapter_label, content, content_sha, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(user_id, *row, created_at) for row in rows],
+        )
+    _get_user_chapters_cached.clear()
+    chapter_options_for.clear()
 
 
-# ------------- CHAPTER STORAGE ------------- #
-def save_chapter(user_id: int, title: str, isbn: str, chapter_label: str, content: str):
+def get_chapters_version(user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO chapters (user_id, title, isbn, chapter_label, content, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (user_id, title, isbn, chapter_label, content, datetime.utcnow().isoformat()),
-    )
-    conn.commit()
-    conn.close()
+    cur = conn.execute("SELECT MAX(created_at) FROM chapters WHERE user_id = ?", (user_id,))
+    return cur.fetchone()[0]
 
 
-def get_user_chapters(user_id: int):
+# version_token changes whenever the user saves a chapter, so the cached list never goes stale.
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_user_chapters_cached(user_id: int, version_token):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    cur = conn.execute(
         "SELECT id, title, isbn, chapter_label, created_at FROM chapters WHERE user_id = ? ORDER BY created_at DESC",
         (user_id,),
     )
     rows = cur.fetchall()
-    conn.close()
+    # st.cache_data pickles return values and sqlite3.Row can't be pickled.
     return [dict(r) for r in rows]
 
 
+def get_user_chapters(user_id: int):
+    return _get_user_chapters_cached(user_id, get_chapters_version(user_id))
+
+
+# Selectbox label -> chapter id, built once per version_token and shared by both pages.
+@st.cache_data(ttl=300, show_spinner=False)
+def chapter_options_for(user_id: int, version_token):
+    chapters = _get_user_chapters_cached(user_id, version_token)
+    return chapters, {
+        f"{c['title'] or 'Untitled'} – {c['chapter_label'] or ''}": c["id"] for c in chapters
+    }
+
+
+def get_chapter_meta(chapter_id: int, user_id: int):
+    conn = get_conn()
+    cur = conn.execute(
+        "SELECT id, title, chapter_label FROM chapters WHERE id = ? AND user_id = ?",
+        (chapter_id, user_id),
+    )
+    # sqlite3.Row already supports lookup by column name; no dict copy needed.
+    return cur.fetchone()
+
+
 def get_chapter_content(chapter_id: int, user_id: int):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM chapters WHERE id = ? AND user_id = ?",
+    cur = conn.execute(
+        """
+        SELECT c.id, c.user_id, c.title, c.isbn, c.chapter_label,
+               COALESCE(b.parsed_text, c.content) AS content, c.created_at
+        FROM chapters c
+        LEFT JOIN file_blobs b ON b.sha = c.content_sha
+        WHERE c.id = ? AND c.user_id = ?
+        """,
         (chapter_id, user_id),
     )
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return dict(row)
-    return None
+    return cur.fetchone()
 
 
 # ------------- SESSION STATE SETUP ------------- #
@@ -315,6 +754,9 @@ def show_auth_page():
 
 
 # ------------- MAIN APP PAGES ------------- #
+STUDENT_LEVELS = ["Middle School", "High School", "Undergraduate", "Graduate"]
+
+
 def show_chapter_page(user):
     st.header("📘 Chapters – Add & Manage")
 
@@ -326,33 +768,43 @@ def show_chapter_page(user):
         with col2:
             chapter_label = st.text_input("Chapter (e.g., 'Chapter 3 – Derivatives')")
 
-        uploaded_file = st.file_uploader(
-            "Upload chapter file (PDF / DOCX / TXT)", type=["pdf", "docx", "txt"]
+        uploaded_files = st.file_uploader(
+            "Upload chapter files (PDF / DOCX / TXT)",
+            type=["pdf", "docx", "txt"],
+            accept_multiple_files=True,
+            help="Each file is saved as its own chapter. With several files, the file name is used as the chapter label.",
         )
         paste_text = st.text_area(
             "Or paste chapter content", height=200, placeholder="Paste chapter text here..."
         )
 
         if st.button("Save chapter"):
-            content = ""
-            if uploaded_file:
-                if uploaded_file.type == "application/pdf":
-                    content = extract_text_from_pdf(uploaded_file)
-                elif (
-                    uploaded_file.type
-                    == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                ):
-                    content = extract_text_from_docx(uploaded_file)
-                else:
-                    content = uploaded_file.read().decode("utf-8")
-            else:
-                content = paste_text
-
-            if not content.strip():
+            rows = []
+            blobs = []
+            if uploaded_files:
+                for uploaded_file in uploaded_files:
+                    sha, content = extract_text_from_upload(uploaded_file)
+                    if not content.strip():
+                        continue
+                    label = (
+                        chapter_label
+                        if len(uploaded_files) == 1
+                        else os.path.splitext(uploaded_file.name)[0]
+                    )
+                    rows.append((title, isbn, label, "", sha))
+                    blobs.append((sha, content))
+            elif paste_text.strip():
+                rows.append((title, isbn, chapter_label, paste_text, None))
+
+            if not rows:
                 st.error("Please upload or paste some chapter content.")
             else:
-                save_chapter(user["id"], title, isbn, chapter_label, content)
-                st.success("Chapter saved successfully.")
+                save_chapters(user["id"], rows, blobs)
+                st.success(
+                    "Chapter saved successfully."
+                    if len(rows) == 1
+                    else f"{len(rows)} chapters saved successfully."
+                )
                 st.rerun()
 
     st.subheader("📂 Your saved chapters")
@@ -367,18 +819,55 @@ def show_chapter_page(user):
             )
 
 
+def show_quiz_result(chapter, quiz_text, usage):
+    st.success("Quiz generated.")
+    with st.expander("Token usage"):
+        st.json(usage)
+
+    st.download_button(
+        "⬇️ Download quiz as .txt",
+        quiz_text,
+        file_name="quiz.txt",
+        mime="text/plain",
+    )
+
+    # Printable HTML version
+    html_print = _build_printable_html(
+        "Quiz", chapter["title"] or "", chapter["chapter_label"] or "", quiz_text
+    )
+    st.markdown(make_print_button(html_print, "🖨️ Print quiz"), unsafe_allow_html=True)
+
+
+def show_cheat_sheet_result(chapter, cheat_text, usage):
+    st.success("Cheat sheet generated.")
+    with st.expander("Token usage"):
+        st.json(usage)
+
+    st.download_button(
+        "⬇️ Download cheat sheet as .txt",
+        cheat_text,
+        file_name="cheat_sheet.txt",
+        mime="text/plain",
+    )
+
+    html_print = _build_printable_html(
+        "Cheat Sheet", chapter["title"] or "", chapter["chapter_label"] or "", cheat_text
+    )
+    st.markdown(make_print_button(html_print, "🖨️ Print cheat sheet"), unsafe_allow_html=True)
+
+
 def show_quiz_page(user):
     st.header("📝 Generate Quiz")
 
-    chapters = get_user_chapters(user["id"])
+    chapters, chapter_options = chapter_options_for(user["id"], get_chapters_version(user["id"]))
     if not chapters:
         st.info("You have no chapters yet. Go to *Chapters* and add one first.")
         return
 
-    chapter_options = {f"{c['title'] or 'Untitled'} – {c['chapter_label'] or ''}": c["id"] for c in chapters}
     selected_label = st.selectbox("Select a chapter", list(chapter_options.keys()))
     chapter_id = chapter_options[selected_label]
-    chapter = get_chapter_content(chapter_id, user["id"])
+    # Only the label is needed per rerun; the full text is loaded on generate.
+    chapter = get_chapter_meta(chapter_id, user["id"])
 
     st.markdown(f"**Selected chapter:** {chapter['title'] or 'Untitled'} – {chapter['chapter_label'] or ''}")
 
@@ -400,10 +889,21 @@ def show_quiz_page(user):
         num_subjective = st.number_input("Subjective questions", 0, 50, 3)
         num_tf = st.number_input("True/False", 0, 50, 2)
 
-    if st.button("Generate quiz"):
+    cheat_sheet_level = st.selectbox(
+        "Cheat sheet student level (for \"Generate quiz + cheat sheet\")",
+        STUDENT_LEVELS,
+        index=2,
+    )
+
+    generate_quiz_clicked = st.button("Generate quiz")
+    generate_both_clicked = st.button("Generate quiz + cheat sheet")
+
+    if generate_quiz_clicked:
+        content = get_chapter_content(chapter_id, user["id"])["content"]
+        st.markdown("### 📄 Quiz (teacher view)")
         with st.spinner("Generating quiz with AI..."):
-            quiz_text = generate_quiz_from_text(
-                text=chapter["content"],
+            stream, usage = generate_quiz_from_text(
+                text=content,
                 chapter_label=chapter["chapter_label"] or "",
                 question_type=question_type,
                 difficulty=difficulty,
@@ -411,93 +911,66 @@ def show_quiz_page(user):
                 num_subjective=num_subjective,
                 num_tf=num_tf,
             )
+            quiz_text = st.write_stream(stream)
+
+        show_quiz_result(chapter, quiz_text, usage)
+
+    elif generate_both_clicked:
+        content = get_chapter_content(chapter_id, user["id"])["content"]
+        with st.spinner("Generating quiz and cheat sheet with AI..."):
+            (quiz_text, quiz_usage), (cheat_text, cheat_usage) = asyncio.run(
+                generate_both(
+                    text=content,
+                    chapter_label=chapter["chapter_label"] or "",
+                    question_type=question_type,
+                    difficulty=difficulty,
+                    num_mcq=num_mcq,
+                    num_subjective=num_subjective,
+                    num_tf=num_tf,
+                    cheat_sheet_level=cheat_sheet_level,
+                )
+            )
 
-        st.success("Quiz generated.")
         st.markdown("### 📄 Quiz (teacher view)")
         st.markdown(quiz_text)
+        show_quiz_result(chapter, quiz_text, quiz_usage)
 
-        st.download_button(
-            "⬇️ Download quiz as .txt",
-            quiz_text,
-            file_name="quiz.txt",
-            mime="text/plain",
-        )
-
-        # Printable HTML version
-        html_print = f"""
-        <html>
-        <head>
-        <title>Quiz – {chapter['chapter_label']}</title>
-        <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; }}
-        h1, h2 {{ text-align: center; }}
-        </style>
-        </head>
-        <body>
-        <h1>Quiz</h1>
-        <h2>{chapter['title'] or ''} – {chapter['chapter_label'] or ''}</h2>
-        <div>{quiz_text.replace("\n", "<br>")}</div>
-        </body>
-        </html>
-        """
-        st.markdown(make_print_button(html_print, "🖨️ Print quiz"), unsafe_allow_html=True)
+        st.markdown("### 📄 Cheat Sheet (student handout)")
+        st.markdown(cheat_text)
+        show_cheat_sheet_result(chapter, cheat_text, cheat_usage)
 
 
 def show_cheat_sheet_page(user):
     st.header("📌 Cheat Sheet / Summary")
 
-    chapters = get_user_chapters(user["id"])
+    chapters, chapter_options = chapter_options_for(user["id"], get_chapters_version(user["id"]))
     if not chapters:
         st.info("You have no chapters yet. Go to *Chapters* and add one first.")
         return
 
-    chapter_options = {f"{c['title'] or 'Untitled'} – {c['chapter_label'] or ''}": c["id"] for c in chapters}
     selected_label = st.selectbox("Select a chapter", list(chapter_options.keys()))
     chapter_id = chapter_options[selected_label]
-    chapter = get_chapter_content(chapter_id, user["id"])
+    # Only the label is needed per rerun; the full text is loaded on generate.
+    chapter = get_chapter_meta(chapter_id, user["id"])
 
     difficulty = st.selectbox(
         "Student level",
-        ["Middle School", "High School", "Undergraduate", "Graduate"],
+        STUDENT_LEVELS,
         index=2,
     )
 
     if st.button("Generate cheat sheet"):
+        content = get_chapter_content(chapter_id, user["id"])["content"]
+        st.markdown("### 📄 Cheat Sheet (student handout)")
         with st.spinner("Generating cheat sheet with AI..."):
-            cheat_text = generate_cheat_sheet(
-                text=chapter["content"],
+            stream, usage = generate_cheat_sheet(
+                text=content,
                 chapter_label=chapter["chapter_label"] or "",
                 difficulty=difficulty,
             )
+            cheat_text = st.write_stream(stream)
 
-        st.success("Cheat sheet generated.")
-        st.markdown("### 📄 Cheat Sheet (student handout)")
-        st.markdown(cheat_text)
-
-        st.download_button(
-            "⬇️ Download cheat sheet as .txt",
-            cheat_text,
-            file_name="cheat_sheet.txt",
-            mime="text/plain",
-        )
-
-        html_print = f"""
-        <html>
-        <head>
-        <title>Cheat Sheet – {chapter['chapter_label']}</title>
-        <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; }}
-        h1, h2 {{ text-align: center; }}
-        </style>
-        </head>
-        <body>
-        <h1>Cheat Sheet</h1>
-        <h2>{chapter['title'] or ''} – {chapter['chapter_label'] or ''}</h2>
-        <div>{cheat_text.replace("\n", "<br>")}</div>
-        </body>
-        </html>
-        """
-        st.markdown(make_print_button(html_print, "🖨️ Print cheat sheet"), unsafe_allow_html=True)
+        show_cheat_sheet_result(chapter, cheat_text, usage)
 
 
 # ------------- ROUTER ------------- #